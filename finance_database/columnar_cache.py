@@ -0,0 +1,359 @@
+"""A read-optimised sidecar store for price history, holding one memory-mapped array per ticker and field."""
+
+import os
+import shutil
+from pathlib import Path
+from urllib.parse import quote, unquote
+import numpy as np
+import pandas as pd
+
+
+class ColumnarCache:
+    """
+    Keeps a copy of price_history as contiguous arrays on disk, one directory per ticker and
+    one raw little-endian file per field. Arrays are opened with np.memmap, so analysis over
+    the full history reads straight from the page cache without going through SQLite.
+
+    Dates are stored as days since the epoch and returned as datetime64[D]. Other fields are
+    stored as float64, with missing values as NaN. Rows are sorted by date.
+
+    The field files of a ticker sit together in a numbered generation directory, named by a
+    small 'current' file. New rows are only ever appended past the end of the current files.
+    Any change to existing rows writes a complete new generation, then switches 'current' to it
+    with os.replace. A reader therefore sees every field from the same generation, and one
+    holding maps of an older generation keeps a complete view of it. The cache never holds its
+    own maps open while writing.
+
+    Attributes:
+        root (Path): Directory holding the cache.
+    """
+
+    FIELDS = ('date', 'open', 'high', 'low', 'close', 'volume')
+    DTYPE = np.dtype('<f8')
+    DATE_DTYPE = np.dtype('<i8')
+
+    def __init__(self, root):
+        """
+        Initializes an instance of ColumnarCache.
+
+        Args:
+            root (str or Path): Directory holding the cache. Created if it doesn't exist.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+
+    def tickers(self):
+        """
+        Lists the tickers held in the cache.
+
+        Returns:
+            list: Ticker codes, sorted.
+        """
+        return sorted(unquote(path.name) for path in self.root.iterdir() if (path / 'current').exists())
+
+
+    def length(self, ticker_code):
+        """
+        Counts the rows cached for a ticker.
+
+        Args:
+            ticker_code (str): The ticker to count.
+
+        Returns:
+            int: Number of complete rows. Fields left longer by an interrupted write are ignored.
+        """
+        return self._length(self._data_path(ticker_code))
+
+
+    def get(self, ticker_code):
+        """
+        Retrieves the cached arrays for a ticker without copying them.
+
+        Args:
+            ticker_code (str): The ticker to retrieve.
+
+        Returns:
+            dict: Read-only arrays keyed by field name. Empty arrays if the ticker is not cached.
+        """
+        for attempt in range(3):
+            data_path = self._data_path(ticker_code)
+            n = self._length(data_path)
+            try:
+                arrays = {}
+                for field in self.FIELDS:
+                    dtype = self.DATE_DTYPE if field == 'date' else self.DTYPE
+                    if n == 0:
+                        array = np.empty(0, dtype=dtype)
+                    else:
+                        array = np.memmap(data_path / f'{field}.bin', dtype=dtype, mode='r', shape=(n,))
+                    arrays[field] = array.view('datetime64[D]') if field == 'date' else array
+                return arrays
+            except FileNotFoundError:
+                # The generation was replaced and removed while opening it, so read the new one
+                if attempt == 2:
+                    raise
+
+
+    def get_frame(self, ticker_code):
+        """
+        Retrieves the cached history for a ticker as a DataFrame indexed by date.
+
+        Args:
+            ticker_code (str): The ticker to retrieve.
+
+        Returns:
+            DataFrame: The cached history. Unlike get, the data is copied into memory.
+        """
+        arrays = self.get(ticker_code)
+        dates = arrays.pop('date')
+        return pd.DataFrame({field: np.array(array) for field, array in arrays.items()}, index=pd.DatetimeIndex(dates, name='date'))
+
+
+    def update(self, db, price_history):
+        """
+        Brings the cache up to date with rows which were just upserted into price_history.
+
+        Rows dated after the cached history are appended to the tail. Rows repeating the last
+        cached dates, as a download starting from the last stored session does, are compared
+        with the cache and only cause a rewrite from that point if a value changed. Anything
+        else, such as a backfill of older history, a ticker not yet cached or data missing some
+        fields, causes the affected tickers to be rebuilt from the database.
+
+        Args:
+            db (SQLiteWrapper): The database holding price_history.
+            price_history (DataFrame): The rows which were upserted.
+        """
+        if len(price_history) == 0:
+            return
+
+        if not set(self.FIELDS).issubset(price_history.columns):
+            # The upsert only changed some columns, so the full rows must come from the database
+            self.rebuild(db, price_history['ticker_code'].unique())
+            return
+
+        tickers_to_rebuild = []
+        for ticker_code, new_rows in price_history.groupby('ticker_code', sort=False):
+            new_rows = self._to_arrays(new_rows)
+            cached_dates = self._read_dates(ticker_code)
+
+            keep = np.searchsorted(cached_dates, new_rows['date'][0])
+            if len(cached_dates) == 0 or not np.isin(cached_dates[keep:], new_rows['date']).all():
+                tickers_to_rebuild.append(ticker_code)
+                continue
+
+            # New rows dated up to the last cached date overlap the cached tail
+            overlap = np.searchsorted(new_rows['date'], cached_dates[-1], side='right')
+            cached_tail = self._read_rows(ticker_code, keep)
+            unchanged = all(
+                np.array_equal(cached_tail[field], new_rows[field][:overlap], equal_nan=(field != 'date'))
+                for field in self.FIELDS
+                )
+
+            if unchanged:
+                if overlap < len(new_rows['date']):
+                    tail = {field: array[overlap:] for field, array in new_rows.items()}
+                    self._write(ticker_code, tail, keep_rows=len(cached_dates))
+            else:
+                self._write(ticker_code, new_rows, keep_rows=keep)
+
+        if tickers_to_rebuild:
+            self.rebuild(db, tickers_to_rebuild)
+
+
+    def truncate(self, from_date):
+        """
+        Removes cached rows on or after a date, mirroring a delete from price_history.
+
+        Args:
+            from_date (date): The first date to remove.
+        """
+        from_date = np.datetime64(from_date, 'D')
+        for ticker_code in self.tickers():
+            cached_dates = self._read_dates(ticker_code)
+            keep = np.searchsorted(cached_dates, from_date)
+            if keep == 0:
+                # No rows left, so drop the ticker as it no longer appears in price_history
+                shutil.rmtree(self._ticker_path(ticker_code))
+            elif keep < len(cached_dates):
+                self._write(ticker_code, self._to_arrays(pd.DataFrame(columns=self.FIELDS)), keep_rows=keep)
+
+
+    def rebuild(self, db, ticker_codes=None):
+        """
+        Rewrites the cache from price_history.
+
+        Args:
+            db (SQLiteWrapper): The database holding price_history.
+            ticker_codes (list, optional): Tickers to rebuild. Defaults to rebuilding every ticker.
+        """
+        if ticker_codes is None:
+            ticker_codes = self._stored_tickers(db)
+            # Also clears directories without a current generation, such as from an interrupted first write
+            stored_tickers = set(ticker_codes)
+            for path in self.root.iterdir():
+                if path.is_dir() and unquote(path.name) not in stored_tickers:
+                    shutil.rmtree(path)
+
+        # One ticker at a time, so only a single history is held in memory
+        codes_rebuilt = 0
+        for ticker_code in dict.fromkeys(ticker_codes):
+            rows = self._read_price_history(db, ticker_code)
+            if len(rows) > 0:
+                self._write(ticker_code, self._to_arrays(rows), keep_rows=0)
+                codes_rebuilt += 1
+            elif self._ticker_path(ticker_code).exists():
+                shutil.rmtree(self._ticker_path(ticker_code))
+
+        print(f"Cache rebuilt for {codes_rebuilt} codes.")
+
+
+    def check(self, db):
+        """
+        Compares the cache against price_history.
+
+        Args:
+            db (SQLiteWrapper): The database holding price_history.
+
+        Returns:
+            list: Tickers whose cached data differs from the database. Empty if the cache is consistent.
+        """
+        stored_tickers = self._stored_tickers(db)
+
+        # One ticker at a time, so only a single history is held in memory
+        inconsistent = []
+        for ticker_code in sorted(set(stored_tickers) | set(self.tickers())):
+            cached = self._read_rows(ticker_code)
+            stored = self._to_arrays(self._read_price_history(db, ticker_code))
+            if len(stored['date']) == 0 or any(
+                not np.array_equal(cached[field], stored[field], equal_nan=(field != 'date'))
+                for field in self.FIELDS
+                ):
+                inconsistent.append(ticker_code)
+
+        if inconsistent:
+            print(f'Cache is inconsistent for {len(inconsistent)} codes: {inconsistent}')
+        else:
+            print(f'Cache is consistent for {len(stored_tickers)} codes.')
+        return inconsistent
+
+
+    def _stored_tickers(self, db):
+        """Lists the tickers in price_history."""
+        return db.get_query("SELECT DISTINCT ticker_code FROM price_history ORDER BY ticker_code")['ticker_code'].tolist()
+
+
+    def _read_price_history(self, db, ticker_code):
+        """Reads the cached fields of price_history for one ticker."""
+        columns_str = ', '.join([f'[{field}]' for field in ('ticker_code',) + self.FIELDS])
+        return db.get_query(
+            f"SELECT {columns_str} FROM price_history WHERE ticker_code = ? ORDER BY date",
+            parameters=(ticker_code,)
+            )
+
+
+    def _to_arrays(self, rows):
+        """Converts price history rows to arrays in the on-disk layout, sorted by date."""
+        dates = pd.Series(rows['date'], dtype=object).astype(str).str[:10].to_numpy(dtype='datetime64[D]')
+        order = np.argsort(dates, kind='stable')
+        arrays = {'date': dates[order]}
+        for field in self.FIELDS[1:]:
+            arrays[field] = pd.to_numeric(rows[field], errors='coerce').to_numpy(dtype=self.DTYPE)[order]
+        return arrays
+
+
+    def _read_dates(self, ticker_code):
+        """Reads the cached dates for a ticker into memory, so no map of the file is left open."""
+        return self._read_rows(ticker_code, fields=('date',))['date']
+
+
+    def _read_rows(self, ticker_code, start=0, fields=FIELDS):
+        """Reads cached rows from start to the end into memory, so no map of the files is left open."""
+        data_path = self._data_path(ticker_code)
+        count = max(self._length(data_path) - start, 0)
+        rows = {}
+        for field in fields:
+            dtype = self.DATE_DTYPE if field == 'date' else self.DTYPE
+            if count == 0:
+                array = np.empty(0, dtype=dtype)
+            else:
+                array = np.fromfile(data_path / f'{field}.bin', dtype=dtype, count=count, offset=start * 8)
+            rows[field] = array.view('datetime64[D]') if field == 'date' else array
+        return rows
+
+
+    def _write(self, ticker_code, arrays, keep_rows):
+        """Keeps the first keep_rows cached rows for a ticker, followed by the given rows."""
+        ticker_path = self._ticker_path(ticker_code)
+        ticker_path.mkdir(exist_ok=True)
+
+        data_path = self._data_path(ticker_code)
+        n = self._length(data_path)
+        # Appending is only safe when every field ends exactly at the last complete row
+        append = data_path is not None and keep_rows == n and all(
+            (data_path / f'{field}.bin').stat().st_size == n * 8 for field in self.FIELDS
+            )
+
+        if append:
+            for field in self.FIELDS:
+                dtype = self.DATE_DTYPE if field == 'date' else self.DTYPE
+                with open(data_path / f'{field}.bin', 'ab') as f:
+                    f.write(arrays[field].astype(dtype).tobytes())
+            return
+
+        # Write a complete new generation, then switch to it in one step
+        generation = int(data_path.name) + 1 if data_path is not None else 1
+        new_data_path = ticker_path / str(generation)
+        if new_data_path.exists():
+            shutil.rmtree(new_data_path)  # Left over from an interrupted write
+        new_data_path.mkdir()
+
+        for field in self.FIELDS:
+            dtype = self.DATE_DTYPE if field == 'date' else self.DTYPE
+            data = arrays[field].astype(dtype)
+            if keep_rows > 0:
+                data = np.concatenate([np.fromfile(data_path / f'{field}.bin', dtype=dtype, count=keep_rows), data])
+            data.tofile(new_data_path / f'{field}.bin')
+
+        current_path = ticker_path / 'current'
+        temp_path = ticker_path / 'current.tmp'
+        temp_path.write_text(str(generation))
+        os.replace(temp_path, current_path)
+
+        # Older generations may still be mapped by a reader, which prevents removal on Windows.
+        # Anything left behind is retried on the next rewrite.
+        for path in ticker_path.iterdir():
+            if path.name in ('current', new_data_path.name):
+                continue
+            try:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+            except OSError:
+                pass
+
+
+    def _data_path(self, ticker_code):
+        """Directory of the current generation of a ticker's field files, or None if it has none."""
+        current_path = self._ticker_path(ticker_code) / 'current'
+        try:
+            return self._ticker_path(ticker_code) / current_path.read_text().strip()
+        except FileNotFoundError:
+            return None
+
+
+    def _length(self, data_path):
+        """Number of complete rows in a generation directory."""
+        if data_path is None:
+            return 0
+        lengths = []
+        for field in self.FIELDS:
+            field_path = data_path / f'{field}.bin'
+            lengths.append(field_path.stat().st_size // 8 if field_path.exists() else 0)
+        return min(lengths)
+
+
+    def _ticker_path(self, ticker_code):
+        """Directory for a ticker, with characters such as '^' and '=' escaped."""
+        return self.root / quote(ticker_code, safe='')
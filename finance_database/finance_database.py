@@ -6,16 +6,35 @@ Created on Wed Apr 14 20:22:22 2021
 """
 
 import yfinance as yf
-from sqlalchemy import create_engine
+import argparse
 import string
 import time
 from datetime import date, datetime, timedelta
 import pandas as pd
 from sqlite_wrapper import SQLiteWrapper
+from market_schedule import exchange_timezone, latest_completed_session, schedule_updates
+from columnar_cache import ColumnarCache
 import shutil
 from pathlib import Path
 
 
+# Columns stored in price_history, other than the generated id
+PRICE_HISTORY_COLUMNS = [
+    'ticker_code',
+    'date',
+    'open',
+    'high',
+    'low',
+    'close',
+    'volume',
+    'dividends',
+    'stock_splits',
+    'capital_gains'
+]
+
+# How dates without a timezone are read on import, see normalise_price_data
+DATE_BASES = ('local', 'utc')
+
 
 class FinanceDatabaseWrapper(SQLiteWrapper):
 
@@ -60,6 +79,13 @@ class FinanceDatabaseWrapper(SQLiteWrapper):
         CREATE UNIQUE INDEX IF NOT EXISTS idx_price_current_ticker_code_date
         ON price_current ([ticker_code]);
         """
+        ,
+        """
+        CREATE TABLE IF NOT EXISTS ticker_exchange  (
+            [ticker_code]       TEXT PRIMARY KEY,
+            [exchange_timezone] TEXT
+        );
+        """
     ]
 
 
@@ -74,6 +100,31 @@ class FinanceDatabaseWrapper(SQLiteWrapper):
 
             self.execute(statement)
 
+        # Memory-mapped copy of price_history for analysis, kept in step with every save
+        self.cache = ColumnarCache(Path('finance-database-cache'))
+        self.maintain_cache = True  # Switched off while bulk importing, which rebuilds once at the end
+        if not self.cache.tickers():
+            self.cache.rebuild(self)
+
+
+    def save_data(self, df, table_name, if_exists='replace', **kwargs):
+        super().save_data(df, table_name, if_exists=if_exists, **kwargs)
+
+        if table_name == 'price_history' and self.maintain_cache:
+            if if_exists == 'upsert':
+                self.cache.update(self, df)
+            else:
+                self.cache.rebuild(self)
+
+
+    def check_cache(self):
+        # Returns the codes whose cached arrays differ from price_history
+        return self.cache.check(self)
+
+
+    def rebuild_cache(self):
+        self.cache.rebuild(self)
+
 
     def backup(self):
         
@@ -110,6 +161,41 @@ class FinanceDatabaseWrapper(SQLiteWrapper):
         records = self.execute(query,parameters=(ticker_code,), fetch=True)
         last_recorded_date = records[0][0] # First record, first column
 
+        return self._parse_date(last_recorded_date)
+
+
+    def get_last_recorded_dates(self):
+        # Latest date for every ticker in a single query, keyed by ticker_code
+        query = """
+        SELECT ticker_code, MAX(date) FROM price_history
+        GROUP BY ticker_code
+        """
+        records = self.execute(query, fetch=True)
+        return {ticker_code: self._parse_date(last_recorded_date) for ticker_code, last_recorded_date in records}
+
+
+    def get_exchange_timezones(self):
+        # Exchange timezones previously reported by Yahoo Finance, keyed by ticker_code
+        records = self.execute("SELECT ticker_code, exchange_timezone FROM ticker_exchange", fetch=True)
+        return dict(records)
+
+
+    def save_exchange_timezones(self, exchange_timezones):
+        if not exchange_timezones:
+            return
+        df = pd.DataFrame(
+            list(exchange_timezones.items()),
+            columns=['ticker_code', 'exchange_timezone']
+            )
+        self.save_data(
+            df=df,
+            table_name='ticker_exchange',
+            if_exists='upsert',
+            unique_key=['ticker_code']
+            )
+
+
+    def _parse_date(self, last_recorded_date):
         if type(last_recorded_date) is str:
             last_recorded_date = last_recorded_date[:10]
             return date.fromisoformat(last_recorded_date)
@@ -121,6 +207,81 @@ class FinanceDatabaseWrapper(SQLiteWrapper):
         raise ValueError(f'Bad date encountered: {last_recorded_date}')
 
 
+    def import_price_history(self, input_file, chunksize=100_000, date_basis='local'):
+        # Streams a local csv or parquet dump into price_history, chunk by chunk.
+        # Rows are upserted, so existing (ticker_code, date) records are updated rather than duplicated.
+        # date_basis says how dates without a timezone are read, see normalise_price_data.
+        input_file = Path(input_file)
+        print(f'Importing {input_file}')
+
+        if input_file.suffix.lower() == '.parquet':
+            try:
+                import pyarrow.parquet as pq  # Optional dependency, only needed for parquet files
+            except ImportError as e:
+                raise ImportError(
+                    f'Importing {input_file.name} requires pyarrow, which is not installed. '
+                    'Install it with "pip install pyarrow", or convert the file to csv.'
+                    ) from e
+            chunks = (batch.to_pandas() for batch in pq.ParquetFile(input_file).iter_batches(batch_size=chunksize))
+        else:
+            chunks = pd.read_csv(input_file, chunksize=chunksize)
+
+        exchange_timezones = self.get_exchange_timezones()
+        count_query = "SELECT COUNT(*) FROM price_history"
+        rows_before = self.execute(count_query, fetch=True)[0][0]
+
+        rows_read = 0
+        rows_skipped = 0
+        tickers_imported = set()
+        # Per-chunk cache updates would rebuild a ticker for every chunk it appears in
+        self.maintain_cache = False
+        try:
+            for chunk in chunks:
+                rows_read += len(chunk)
+                normalised_chunk = normalise_price_data(chunk, exchange_timezones, date_basis)
+                rows_skipped += len(chunk) - len(normalised_chunk)
+                print(f'    - {rows_read} rows read')
+                if len(normalised_chunk) == 0:
+                    continue
+                self.save_data(
+                    df=normalised_chunk,
+                    table_name='price_history',
+                    if_exists='upsert',
+                    unique_key=['date', 'ticker_code'],
+                    auto_add_id=True
+                    )
+                tickers_imported.update(normalised_chunk['ticker_code'])
+        except BaseException:
+            # Bring the cache in line with the chunks already saved, without hiding the original error
+            try:
+                self.cache.rebuild(self, sorted(tickers_imported))
+            except Exception as e:
+                print(f'Cache could not be rebuilt after the failed import ({e}). Run rebuild-cache.')
+            raise
+        finally:
+            self.maintain_cache = True
+
+        self.cache.rebuild(self, sorted(tickers_imported))
+
+        # Keys repeated across chunks or already in the database update a row rather than adding one
+        rows_added = self.execute(count_query, fetch=True)[0][0] - rows_before
+        print(
+            f'Total of {rows_read} rows read from {input_file}, adding {rows_added} new rows to price_history. '
+            f'{rows_skipped} rows were skipped, having no ticker_code or date, or repeating a key within a chunk.'
+            )
+        return rows_added
+
+
+    def delete_current_prices_not_held(self, companies_held):
+        companies_held = list(dict.fromkeys(companies_held))
+        placeholders_str = ', '.join(['?' for _ in companies_held])
+        delete_query = f"""
+            DELETE FROM price_current
+            WHERE ticker_code NOT IN ({placeholders_str})
+            """
+        self.execute(delete_query, parameters=tuple(companies_held))
+
+
     def delete_last_n_days(self, n):
         delete_from = date.today() - timedelta(days=n)
         delete_from_str = delete_from.isoformat()
@@ -131,6 +292,7 @@ class FinanceDatabaseWrapper(SQLiteWrapper):
             """
         )
         self.execute(delete_query)
+        self.cache.truncate(delete_from)
 
 
 
@@ -141,21 +303,27 @@ def download_data(companies_held, db):
     # All historical data which is retrieved:
     price_history_all = []
     price_current_all = []
+    exchange_timezones = {}
 
     codes_downloaded = 0
 
-    for ticker_code in companies_held:
+    # Skip tickers whose exchange has not closed a session since the last stored date
+    last_recorded_dates = db.get_last_recorded_dates()
+    codes_due = schedule_updates(companies_held, last_recorded_dates, db.get_exchange_timezones())
+    codes_skipped = len(set(companies_held)) - len(codes_due)
+    print(f'{len(codes_due)} codes due for an update, {codes_skipped} already up to date')
+
+    for ticker_code in codes_due:
 
         print('Starting on ' + ticker_code)
         
         # Get the starting date to retrieve from (last data)
-        try:
-            last_recorded_date = db.get_last_recorded_date(ticker_code)
+        last_recorded_date = last_recorded_dates.get(ticker_code)
+        if last_recorded_date is not None:
             next_date_to_dl = last_recorded_date + timedelta(days=1)
             next_date_to_dl = next_date_to_dl.isoformat()
             print(f'    - Database was read ok. Next date to download is {next_date_to_dl}')
-        except Exception as e:
-            print(e)
+        else:
             print('    - Local database could not be read. Will try get all data')
 
             res = input('Local database could not be read. Type "start" to get all data')
@@ -169,6 +337,10 @@ def download_data(companies_held, db):
             yfinance_obj = yf.Ticker(ticker_code)
             price_history_temp = yfinance_obj.history(start=next_date_to_dl)
             price_history_temp['ticker_code'] = ticker_code
+            # The index is localised to the exchange, which the scheduler uses on the next run
+            if price_history_temp.index.tz is not None:
+                exchange_timezones[ticker_code] = str(price_history_temp.index.tz)
+            price_history_temp = drop_unclosed_sessions(price_history_temp, ticker_code, exchange_timezones.get(ticker_code))
             print('    - ' + str(len(price_history_temp))
                   + ' history days retrieved')
             if len(price_history_temp) > 0:
@@ -181,6 +353,12 @@ def download_data(companies_held, db):
 
         time.sleep(0.5)  # to not overload the API
 
+    db.save_exchange_timezones(exchange_timezones)
+
+    if not price_history_all:
+        print('No new history days retrieved')
+        return pd.DataFrame(), pd.DataFrame()
+
     price_history = pd.concat(price_history_all)
     price_current = pd.concat(price_current_all)
     
@@ -196,14 +374,104 @@ def download_data(companies_held, db):
     print(price_current.columns)
 
     # <class 'pandas._libs.tslibs.timestamps.Timestamp'> causing problems
-    price_history['date'] = pd.to_datetime(price_history['date'], utc=True).apply(lambda x: x.date().isoformat())
-    price_current['date'] = pd.to_datetime(price_current['date'], utc=True).apply(lambda x: x.date().isoformat())
+    price_history['date'] = to_iso_date(price_history['date'])
+    price_current['date'] = to_iso_date(price_current['date'])
 
     return price_history, price_current
 
 
-def manual_add_missing_data(data, table, engine):
-    data.to_sql(table, con=engine, if_exists='append')
+def drop_unclosed_sessions(price_history, ticker_code, cached_timezone=None, now=None):
+    # The API returns a partial bar for a session which is still trading. Storing it would make it the
+    # watermark, so the scheduler would skip the after-close run which fetches the final bar.
+    # Expects the index to be the timezone aware session timestamps returned by the API.
+    timezone_name = exchange_timezone(ticker_code, cached_timezone)
+    if timezone_name is None or len(price_history) == 0 or price_history.index.tz is None:
+        return price_history
+
+    last_session = latest_completed_session(timezone_name, now)
+    if last_session is None:
+        return price_history
+
+    session_dates = price_history.index.tz_convert(timezone_name).date
+    unclosed = session_dates > last_session
+    if unclosed.any():
+        print(f'    - Dropped {unclosed.sum()} bar(s) for a session which has not closed')
+    return price_history[~unclosed]
+
+
+def manual_add_missing_data(data, db, date_basis='local'):
+    # Adds price history which is not available from the API, such as for delisted codes
+    db.save_data(
+        df=normalise_price_data(data, db.get_exchange_timezones(), date_basis),
+        table_name='price_history',
+        if_exists='upsert',
+        unique_key=['date', 'ticker_code'],
+        auto_add_id=True
+        )
+
+
+def bulk_import(input_files, chunksize=100_000, date_basis='local'):
+    db = FinanceDatabaseWrapper()
+    for input_file in input_files:
+        db.import_price_history(input_file, chunksize=chunksize, date_basis=date_basis)
+
+
+def normalise_price_data(data, exchange_timezones=None, date_basis='local'):
+    # Brings externally sourced price history into the shape of the price_history table.
+    # date_basis says how dates without a timezone are read:
+    #   'local' - the session date at the ticker's exchange, as in most external dumps. These are shifted
+    #             to the stored UTC basis, using exchange_timezones (ticker_code to the timezone cached
+    #             from the API) or the ticker suffix.
+    #   'utc'   - already on the stored UTC basis, as in the price-history.csv export. Stored unchanged.
+    if date_basis not in DATE_BASES:
+        raise ValueError(f'date_basis parameter not in {DATE_BASES}')
+
+    data = data.copy()
+    data.columns = [to_snake_case(str(col)) for col in data.columns]
+
+    missing_columns = {'ticker_code', 'date'} - set(data.columns)
+    if missing_columns:
+        raise ValueError(f'Price data is missing required columns: {sorted(missing_columns)}')
+
+    data = data[[col for col in PRICE_HISTORY_COLUMNS if col in data.columns]]
+    data = data.dropna(subset=['ticker_code', 'date']).reset_index(drop=True)
+
+    if date_basis == 'utc':
+        data['date'] = to_iso_date(data['date'])
+        return data.drop_duplicates(subset=['ticker_code', 'date'], keep='last')
+
+    exchange_timezones = exchange_timezones or {}
+    ticker_timezones = {
+        ticker_code: exchange_timezones.get(ticker_code) or exchange_timezone(ticker_code)
+        for ticker_code in data['ticker_code'].unique()
+        }
+    unknown_timezones = [ticker_code for ticker_code, tz in ticker_timezones.items() if tz is None]
+    if unknown_timezones:
+        print(f'    - No exchange timezone known for {unknown_timezones}, dates without a timezone are taken as UTC')
+
+    timezones = data['ticker_code'].map(lambda ticker_code: ticker_timezones[ticker_code] or 'UTC')
+    data['date'] = to_iso_date(data['date'], timezones)
+    data = data.drop_duplicates(subset=['ticker_code', 'date'], keep='last')
+    return data
+
+
+def to_iso_date(dates, timezones=None):
+    # Vectorised conversion of dates or timestamps to the ISO date strings stored in the database.
+    # The stored date is the UTC date, as the API returns each session at local midnight of the exchange
+    # (so .AX sessions are stored against the previous calendar day). Naive dates are local session
+    # dates, so are first localised to the timezone given for each row, to be stored the same way.
+    try:
+        dates = pd.to_datetime(dates)
+    except ValueError:
+        dates = pd.to_datetime(dates, utc=True)  # Mixed UTC offsets, so already timezone aware
+
+    if dates.dt.tz is None and timezones is not None and len(dates) > 0:
+        dates = pd.concat([
+            dates[timezones == tz].dt.tz_localize(tz, nonexistent='shift_forward').dt.tz_convert('UTC')
+            for tz in timezones.unique()
+            ]).reindex(dates.index)
+
+    return pd.to_datetime(dates, utc=True).dt.strftime('%Y-%m-%d')
 
 
 def to_snake_case(text):
@@ -220,9 +488,6 @@ def main():
     # ticker_code must contain strings with a ticker matching Yahoo Finance, such as 'VGS.AX'
     file_companies_held = 'companies-held.csv'
 
-    # Files for manually loading in missing data, if applicable
-    file_missing_data_delisted = 'input-missing-data-delisted.csv'
-
     # Data output for PowerBI. Historical timeseries and current price.
     output_file_price_history = 'price-history.csv'
     output_file_price_current = 'price-current.csv'
@@ -241,20 +506,26 @@ def main():
 
     (price_history, price_current) = download_data(companies_held['ticker_code'], db)
 
-
-    db.save_data(
-        df=price_history,
-        table_name='price_history',
-        if_exists='upsert',
-        unique_key=['date', 'ticker_code'],
-        auto_add_id=True
-        )
-    db.save_data(
-        df=price_current,
-        table_name='price_current',
-        if_exists='replace',
-        auto_add_id=True
-        )
+    # Nothing to save when every code was skipped or returned no new days
+    if len(price_history) > 0:
+        db.save_data(
+            df=price_history,
+            table_name='price_history',
+            if_exists='upsert',
+            unique_key=['date', 'ticker_code'],
+            auto_add_id=True
+            )
+        # Upsert rather than replace, so codes skipped by the scheduler keep their current price.
+        db.save_data(
+            df=price_current,
+            table_name='price_current',
+            if_exists='upsert',
+            unique_key=['ticker_code'],
+            auto_add_id=True
+            )
+
+    # Drop codes which are no longer held, so price_current matches companies_held
+    db.delete_current_prices_not_held(companies_held['ticker_code'])
 
     # These output copies of the database to csv files, for use in PowerBI.
     db.export_data_to_csv(
@@ -268,4 +539,33 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+
+    parser = argparse.ArgumentParser(description='Incrementally store stock price history in a local database.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    # Files for manually loading in missing data, if applicable
+    import_parser = subparsers.add_parser('import', help='Bulk import price history from local csv or parquet files.')
+    import_parser.add_argument('input_files', nargs='*', default=['input-missing-data-delisted.csv'])
+    import_parser.add_argument('--chunksize', type=int, default=100_000)
+    import_parser.add_argument(
+        '--dates-are-utc',
+        action='store_true',
+        help=(
+            "Dates without a timezone are already on the database's UTC basis, as in the price-history.csv export. "
+            "By default they are taken as the local session date at each ticker's exchange."
+            )
+        )
+
+    subparsers.add_parser('check-cache', help='Compare the columnar cache against price_history.')
+    subparsers.add_parser('rebuild-cache', help='Rewrite the columnar cache from price_history.')
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        bulk_import(args.input_files, chunksize=args.chunksize, date_basis='utc' if args.dates_are_utc else 'local')
+    elif args.command == 'check-cache':
+        FinanceDatabaseWrapper().check_cache()
+    elif args.command == 'rebuild-cache':
+        FinanceDatabaseWrapper().rebuild_cache()
+    else:
+        main()
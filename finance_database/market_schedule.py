@@ -0,0 +1,305 @@
+"""Works out whether a ticker's exchange has closed a new trading session since the last stored price,
+so that downloads which cannot return any new bars can be skipped."""
+
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+
+# Yahoo Finance ticker suffix -> exchange timezone.
+# Tickers without a suffix are US listings.
+SUFFIX_TIMEZONES = {
+    'AX': 'Australia/Sydney',
+    'NZ': 'Pacific/Auckland',
+    'L': 'Europe/London',
+    'IL': 'Europe/London',
+    'DE': 'Europe/Berlin',
+    'F': 'Europe/Berlin',
+    'PA': 'Europe/Paris',
+    'AS': 'Europe/Amsterdam',
+    'SW': 'Europe/Zurich',
+    'MI': 'Europe/Rome',
+    'MC': 'Europe/Madrid',
+    'TO': 'America/Toronto',
+    'V': 'America/Toronto',
+    'HK': 'Asia/Hong_Kong',
+    'T': 'Asia/Tokyo',
+    'SI': 'Asia/Singapore',
+    'KS': 'Asia/Seoul',
+    'SS': 'Asia/Shanghai',
+    'SZ': 'Asia/Shanghai',
+    'NS': 'Asia/Kolkata',
+    'BO': 'Asia/Kolkata',
+}
+
+US_TIMEZONE = 'America/New_York'
+
+# Exchange timezone -> local time at which the regular session closes.
+SESSION_CLOSE_TIMES = {
+    'Australia/Sydney': time(16, 10),
+    'Pacific/Auckland': time(16, 45),
+    'Europe/London': time(16, 35),
+    'Europe/Berlin': time(17, 35),
+    'Europe/Paris': time(17, 35),
+    'Europe/Amsterdam': time(17, 35),
+    'Europe/Zurich': time(17, 30),
+    'Europe/Rome': time(17, 35),
+    'Europe/Madrid': time(17, 35),
+    'America/New_York': time(16, 0),
+    'America/Toronto': time(16, 0),
+    'Asia/Hong_Kong': time(16, 10),
+    'Asia/Tokyo': time(15, 30),
+    'Asia/Singapore': time(17, 6),
+    'Asia/Seoul': time(15, 30),
+    'Asia/Shanghai': time(15, 0),
+    'Asia/Kolkata': time(15, 30),
+}
+
+# Allow time for the daily bar to be finalised by the data provider after the close.
+SETTLEMENT_DELAY = timedelta(minutes=30)
+
+# Suffixes of instruments which trade around the clock, so are always worth requesting.
+CONTINUOUS_TRADING_MARKERS = ('=X', '=F', '-USD', '-AUD', '-EUR', '-GBP')
+
+
+def exchange_timezone(ticker_code, cached_timezone=None):
+    """
+    Determines the exchange timezone for a ticker.
+
+    Args:
+        ticker_code (str): A Yahoo Finance ticker, such as 'VGS.AX'.
+        cached_timezone (str, optional): The timezone previously reported by Yahoo Finance for this ticker.
+
+    Returns:
+        str: The timezone name, or None if the ticker has no known session calendar.
+    """
+    if ticker_code.upper().endswith(CONTINUOUS_TRADING_MARKERS):
+        return None
+
+    if cached_timezone:
+        return cached_timezone
+
+    if ticker_code.startswith('^'):
+        return None  # Indices carry no suffix, so their exchange must come from the cache
+
+    if '.' in ticker_code:
+        suffix = ticker_code.rsplit('.', 1)[1].upper()
+        return SUFFIX_TIMEZONES.get(suffix)
+
+    return US_TIMEZONE
+
+
+def is_trading_day(day, timezone_name):
+    """
+    Checks whether the exchange for a timezone holds a regular session on a given day.
+
+    Weekends are always closed. Public holidays are only known for the Australian, US and UK markets.
+
+    Args:
+        day (date): The local date at the exchange.
+        timezone_name (str): The exchange timezone.
+
+    Returns:
+        bool: True if the exchange is open on that day.
+    """
+    if day.weekday() >= 5:
+        return False
+    return day not in _holidays(timezone_name, day.year)
+
+
+def latest_completed_session(timezone_name, now=None):
+    """
+    Finds the most recent trading session which has closed at an exchange.
+
+    Args:
+        timezone_name (str): The exchange timezone.
+        now (datetime, optional): Timezone aware current time. Defaults to the system time.
+
+    Returns:
+        date: The local date of the latest closed session, or None if the exchange is not known.
+    """
+    if timezone_name not in SESSION_CLOSE_TIMES:
+        return None
+
+    if now is None:
+        now = datetime.now(timezone.utc)
+
+    exchange_tz = ZoneInfo(timezone_name)
+    local_now = now.astimezone(exchange_tz)
+    session_day = local_now.date()
+
+    close_today = datetime.combine(session_day, SESSION_CLOSE_TIMES[timezone_name], tzinfo=exchange_tz)
+    if local_now < close_today + SETTLEMENT_DELAY:
+        session_day -= timedelta(days=1)
+
+    while not is_trading_day(session_day, timezone_name):
+        session_day -= timedelta(days=1)
+
+    return session_day
+
+
+def is_update_due(ticker_code, last_recorded_date, cached_timezone=None, now=None):
+    """
+    Determines whether a download for a ticker could return any bars not already stored.
+
+    Args:
+        ticker_code (str): A Yahoo Finance ticker, such as 'VGS.AX'.
+        last_recorded_date (date): The latest date stored for the ticker, or None if there is no data.
+        cached_timezone (str, optional): The timezone previously reported by Yahoo Finance for this ticker.
+        now (datetime, optional): Timezone aware current time. Defaults to the system time.
+
+    Returns:
+        bool: False only when the stored data already covers the latest closed session.
+    """
+    if last_recorded_date is None:
+        return True
+
+    timezone_name = exchange_timezone(ticker_code, cached_timezone)
+    if timezone_name is None:
+        return True
+
+    session_day = latest_completed_session(timezone_name, now)
+    if session_day is None:
+        return True
+
+    # Dates are stored as the UTC date of the session's local midnight (see download_data),
+    # so the watermark is compared on the same basis.
+    session_start = datetime.combine(session_day, time(0), tzinfo=ZoneInfo(timezone_name))
+    session_stored_date = session_start.astimezone(timezone.utc).date()
+
+    return last_recorded_date < session_stored_date
+
+
+def schedule_updates(ticker_codes, last_recorded_dates, cached_timezones=None, now=None):
+    """
+    Selects the tickers which need downloading, with the most out of date first.
+
+    Args:
+        ticker_codes (iterable): The tickers to consider.
+        last_recorded_dates (dict): Latest stored date for each ticker. Tickers without data may be omitted.
+        cached_timezones (dict, optional): Exchange timezone previously reported for each ticker.
+        now (datetime, optional): Timezone aware current time. Defaults to the system time.
+
+    Returns:
+        list: The tickers to download, starting with those which have no data, then the stalest.
+    """
+    cached_timezones = cached_timezones or {}
+    if now is None:
+        now = datetime.now(timezone.utc)
+
+    tickers_due = [
+        ticker_code for ticker_code in dict.fromkeys(ticker_codes)
+        if is_update_due(ticker_code, last_recorded_dates.get(ticker_code), cached_timezones.get(ticker_code), now)
+        ]
+
+    def staleness(ticker_code):
+        last_recorded_date = last_recorded_dates.get(ticker_code)
+        return (last_recorded_date is not None, last_recorded_date or date.min)
+
+    return sorted(tickers_due, key=staleness)
+
+
+@lru_cache
+def _holidays(timezone_name, year):
+    """Returns the set of weekday exchange holidays for a timezone and year."""
+    if timezone_name == 'Australia/Sydney':
+        return _asx_holidays(year)
+    if timezone_name == 'America/New_York':
+        return _nyse_holidays(year)
+    if timezone_name == 'Europe/London':
+        return _lse_holidays(year)
+    return frozenset()
+
+
+def _easter_sunday(year):
+    """Anonymous Gregorian algorithm for the date of Easter Sunday."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _nth_weekday(year, month, weekday, n):
+    """The nth (1-based) occurrence of a weekday in a month. Negative n counts from the end of the month."""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7 + 7 * (-n - 1))
+
+
+def _substitute_forward(days):
+    """Moves holidays falling on a weekend to the next free weekday, as done in Australia and the UK."""
+    observed = set()
+    for day in sorted(days):
+        while day.weekday() >= 5 or day in observed:
+            day += timedelta(days=1)
+        observed.add(day)
+    return observed
+
+
+def _asx_holidays(year):
+    easter = _easter_sunday(year)
+    holidays = _substitute_forward([
+        date(year, 1, 1),
+        date(year, 1, 26),
+        date(year, 12, 25),
+        date(year, 12, 26),
+        ])
+    holidays.update([
+        easter - timedelta(days=2),  # Good Friday
+        easter + timedelta(days=1),  # Easter Monday
+        date(year, 4, 25),  # Anzac Day, not substituted
+        _nth_weekday(year, 6, 0, 2),  # King's Birthday
+        ])
+    return frozenset(holidays)
+
+
+def _lse_holidays(year):
+    easter = _easter_sunday(year)
+    holidays = _substitute_forward([
+        date(year, 1, 1),
+        date(year, 12, 25),
+        date(year, 12, 26),
+        ])
+    holidays.update([
+        easter - timedelta(days=2),  # Good Friday
+        easter + timedelta(days=1),  # Easter Monday
+        _nth_weekday(year, 5, 0, 1),  # Early May bank holiday
+        _nth_weekday(year, 5, 0, -1),  # Spring bank holiday
+        _nth_weekday(year, 8, 0, -1),  # Summer bank holiday
+        ])
+    return frozenset(holidays)
+
+
+def _nyse_holidays(year):
+    def observed(day):
+        # Saturday holidays are observed on the Friday, Sunday holidays on the Monday
+        if day.weekday() == 5:
+            return day - timedelta(days=1)
+        if day.weekday() == 6:
+            return day + timedelta(days=1)
+        return day
+
+    holidays = {
+        _nth_weekday(year, 1, 0, 3),  # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3),  # Washington's Birthday
+        _easter_sunday(year) - timedelta(days=2),  # Good Friday
+        _nth_weekday(year, 5, 0, -1),  # Memorial Day
+        observed(date(year, 7, 4)),
+        _nth_weekday(year, 9, 0, 1),  # Labor Day
+        _nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        observed(date(year, 12, 25)),
+        }
+    if year >= 2022:
+        holidays.add(observed(date(year, 6, 19)))  # Juneteenth
+    if date(year, 1, 1).weekday() != 5:
+        holidays.add(observed(date(year, 1, 1)))  # Not moved back into the prior year when on a Saturday
+    return frozenset(holidays)
@@ -2,8 +2,10 @@
 
 import sqlite3
 import os
+import re
 import string
 import uuid
+from datetime import date, datetime, timedelta
 import numpy as np
 import pandas as pd
 
@@ -163,15 +165,7 @@ class SQLiteWrapper:
                 DO UPDATE SET {set_clause_str}
                 """
 
-            def convert_types(t):
-                converted_tuple = tuple(
-                    int(x) if isinstance(x, np.integer) else
-                    float(x) if isinstance(x, np.floating) else
-                    x for x in t
-                    )
-                return converted_tuple
-
-            records = [convert_types(record) for record in df.to_records(index=False)]
+            records = self._df_to_records(df)
 
             try:
                 self._executemany(upsert_sql, records)
@@ -179,24 +173,17 @@ class SQLiteWrapper:
                 self._handle_exception(e)
 
         elif if_exists == 'replace':
-            # Pandas replace method will remove any DDL, so this is used to retain it.
             if self.table_exists(table_name):
+                # Pandas replace method will remove any DDL, so the data is swapped in via a shadow table instead.
                 try:
-                    table_delete_sql = f"DELETE FROM [{table_name}]"
-                    self._execute(table_delete_sql)
+                    self._replace_via_shadow_table(df, table_name)
                 except Exception as e:
-                    print(f"Error deleting the data already saved to table '{table_name}', likely due to a foreign key constraint.")
+                    print(f"Error replacing the data in table '{table_name}'. The original table was left unchanged.")
                     self._handle_exception(e)
-        
-            # Table was cleared, retaining its original DDL and contraints. Now use append to add the new data.
-            try:
-                with sqlite3.connect(self.db_path) as conn:
-                    df.to_sql(table_name, conn, if_exists='append', index=False)
-            except Exception:
-                # Incompatible schema. Fall back to replace. This will replace the table.
+            else:
+                # Nothing to preserve, so let pandas create the table.
                 with sqlite3.connect(self.db_path) as conn:
                     df.to_sql(table_name, conn, if_exists='replace', index=False)
-                
 
         elif if_exists in ('append', 'fail'):
             with sqlite3.connect(self.db_path) as conn:
@@ -206,6 +193,67 @@ class SQLiteWrapper:
         print(f"Data saved to table '{table_name}' successfully.")
 
 
+    def _replace_via_shadow_table(self, df, table_name):
+        """
+        Replaces the contents of an existing table in a single transaction.
+
+        The new data is bulk loaded into a shadow table created from the stored DDL of the
+        original table. The original is then dropped, the shadow renamed into its place and
+        the original indexes and triggers recreated. Readers on other connections see either
+        the old or the new table, never an empty one, and the constraints are retained.
+
+        Args:
+            df (DataFrame): The data to save.
+            table_name (str): The name of the existing table to replace. Must already be sanitised.
+
+        Raises:
+            sqlite3.Error: If the data does not fit the table schema. The transaction is rolled back.
+        """
+        shadow_table_name = f'{table_name}__shadow'
+
+        table_ddl = self.get_table_ddl(table_name)
+        shadow_table_ddl = re.sub(
+            r'^CREATE TABLE\s+(?:IF NOT EXISTS\s+)?("[^"]*"|\[[^\]]*\]|`[^`]*`|[^\s(]+)',
+            f'CREATE TABLE [{shadow_table_name}]',
+            table_ddl,
+            count=1,
+            flags=re.IGNORECASE
+            )
+
+        dependent_ddl_query = """
+            SELECT sql
+            FROM sqlite_master
+            WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql IS NOT NULL;
+            """
+        dependent_ddl = [record[0] for record in self._execute(dependent_ddl_query, (table_name,), fetch=True)]
+
+        column_list = self._sanitise_input_list(df.columns)
+        columns_str = ', '.join([f'[{col_name}]' for col_name in column_list])
+        placeholders_str = ', '.join(['?' for col_name in column_list])
+        insert_sql = f"INSERT INTO [{shadow_table_name}] ({columns_str}) VALUES ({placeholders_str})"
+
+        records = self._df_to_records(df)
+
+        # Autocommit mode, so the transaction boundaries below are explicit and also cover the DDL.
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(f"DROP TABLE IF EXISTS [{shadow_table_name}]") # Left over from an interrupted run
+            conn.execute(shadow_table_ddl)
+            conn.executemany(insert_sql, records)
+            conn.execute(f"DROP TABLE [{table_name}]")
+            conn.execute(f"ALTER TABLE [{shadow_table_name}] RENAME TO [{table_name}]")
+            for statement in dependent_ddl:
+                conn.execute(statement)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+
     def get_table(self, table_name):
         """
         Retrieves all data from a specified table.
@@ -355,6 +403,57 @@ class SQLiteWrapper:
         return [self._sanitise_input(item) for item in array]
 
 
+    def _df_to_records(self, df):
+        """
+        Converts a DataFrame to a list of tuples suitable for executemany.
+
+        Datetimes are bound as ISO formatted text, matching what DataFrame.to_sql stores.
+
+        Args:
+            df (DataFrame): The data to convert.
+
+        Returns:
+            list: List of tuples, with numpy scalars converted to native Python types.
+
+        Raises:
+            ValueError: If a column has a dtype which cannot be stored as a scalar, such as timedelta.
+        """
+        def convert_value(x):
+            if isinstance(x, np.integer):
+                return int(x)
+            if isinstance(x, np.floating):
+                return float(x)
+            if isinstance(x, np.datetime64):
+                return None if np.isnat(x) else pd.Timestamp(x).to_pydatetime().isoformat(' ')
+            if isinstance(x, datetime):
+                return None if pd.isna(x) else x.isoformat(' ')
+            if isinstance(x, date):
+                return x.isoformat()
+            if isinstance(x, (np.timedelta64, timedelta)):
+                raise ValueError(f'Unsupported value for database storage: {x!r}')
+            return x
+
+        # Each column is converted as a whole, so values are only inspected one by one
+        # in object columns holding something other than strings.
+        columns = []
+        for col in df.columns:
+            series = df[col]
+            if pd.api.types.is_datetime64_any_dtype(series):
+                # Native datetimes would otherwise be bound by sqlite3 as raw bytes
+                values = [None if pd.isna(x) else x.to_pydatetime().isoformat(' ') for x in series]
+            elif pd.api.types.is_timedelta64_dtype(series):
+                raise ValueError(f"Column '{col}' has unsupported dtype {series.dtype}")
+            elif isinstance(series.dtype, np.dtype) and series.dtype != object:
+                values = series.tolist()  # Numpy numbers become native int, float and bool
+            else:
+                values = series.astype(object).where(series.notna(), None).tolist()
+                if pd.api.types.infer_dtype(values, skipna=True) not in ('string', 'empty'):
+                    values = [convert_value(x) for x in values]
+            columns.append(values)
+
+        return list(zip(*columns))
+
+
     def _handle_exception(self, e, raise_it=True):
         print(f'Sql error: {" ".join(e.args)}')
         print(f'Exception class is: {e.__class__}')